@@ -7,40 +7,86 @@
 # - Optionally calibrates to the current on-chain balance for an absolute curve
 # - Saves JSONL, CSV, tail CSV, and two plots
 
-import argparse, json, os, sys, time
-from typing import Any, Dict, List, Optional, Tuple
-from decimal import Decimal, InvalidOperation, getcontext
+import argparse, asyncio, csv, json, os, sqlite3, sys, threading, time
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from decimal import Context, Decimal, InvalidOperation
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
+from operator import itemgetter
+from urllib.parse import urlencode
+
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 try:
-    import matplotlib
-    matplotlib.use("Agg")
-    import matplotlib.pyplot as plt
+    # Figure objects instead of pyplot: pyplot keeps global state and the plots are rendered from worker threads
+    from matplotlib.figure import Figure
     import matplotlib.ticker as mticker
+    import numpy as np
 except Exception:
-    plt = None
+    Figure = None
 
-getcontext().prec = 28
 BASE_URL = "https://api.idena.io/api"
+IDNA_DECIMALS = 18
+ATOMIC = 10 ** IDNA_DECIMALS
+# wide enough that scaling to atomic units never rounds, whatever the global context says
+ATOMIC_CTX = Context(prec=80)
+USER_AGENT = "idena-balance-timeline/gh-1.0"
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = (500, 502, 503, 504)
+CACHE_DB = "cache.sqlite"
+SQL_CHUNK = 500
+WRITE_BUFFER = 1 << 20
+TIMELINE_COLS = ["hash","block","timestamp","direction","amount","fee","tips","type","delta","balance"]
+# the pager runs in a worker thread next to the event loop, both touch the cache connection
+_cache_lock = threading.Lock()
 
 # ---------- helpers ----------
 
 def D(x) -> Decimal:
     try:
-        if x is None:
+        # the API sends amounts as strings; Decimal() already ignores surrounding whitespace
+        if type(x) is str:
+            d = Decimal(x)
+        elif x is None:
+            return Decimal(0)
+        elif isinstance(x, (int, float)):
+            d = Decimal(str(x))
+        elif isinstance(x, str):
+            d = Decimal(x.strip())
+        else:
             return Decimal(0)
-        if isinstance(x, (int, float)):
-            return Decimal(str(x))
-        if isinstance(x, str):
-            return Decimal(x.strip())
-        return Decimal(0)
     except InvalidOperation:
         return Decimal(0)
+    # NaN/Infinity would blow up in to_atomic
+    return d if d.is_finite() else Decimal(0)
+
+def to_atomic(x: Decimal) -> int:
+    return int(x.scaleb(IDNA_DECIMALS, ATOMIC_CTX))
+
+def fmt_atomic(n: int) -> str:
+    sign = "-" if n < 0 else ""
+    whole, frac = divmod(abs(n), ATOMIC)
+    if not frac:
+        return f"{sign}{whole}"
+    return f"{sign}{whole}." + str(frac).rjust(IDNA_DECIMALS, "0").rstrip("0")
 
 def i(v, default=0) -> int:
+    if type(v) is int:
+        return v
     try:
         if v is None:
             return default
@@ -92,26 +138,126 @@ def epoch(ts) -> int:
                 return 0
     return 0
 
+@lru_cache(maxsize=4096)
 def iso_utc(ts_int: int) -> str:
     try:
-        return datetime.utcfromtimestamp(int(ts_int)).strftime("%Y-%m-%d %H:%M:%S")
+        return datetime.fromtimestamp(int(ts_int), tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
     except Exception:
         return ""
 
+def json_loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any, newline: bool=False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE if newline else None)
+    # same compact form as orjson, so output does not depend on which one is installed
+    s = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    return (s + "\n" if newline else s).encode("utf-8")
+
 def get_ci(dct: Dict[str, Any], *names):
     if not isinstance(dct, dict):
         return None
     if not names:
         return None
-    keys = {k.lower(): k for k in dct.keys()}
+    keys = None
     for n in names:
+        if n in dct:
+            return dct[n]
+        if keys is None:
+            keys = {k.lower(): k for k in dct.keys()}
         k = keys.get(n.lower())
         if k is not None:
             return dct[k]
     return None
 
+# ---------- cache ----------
+
+def open_cache(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, CACHE_DB), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS tx(hash TEXT PRIMARY KEY, body BLOB, status INTEGER)")
+    if "status" not in {row[1] for row in conn.execute("PRAGMA table_info(tx)")}:
+        conn.execute("ALTER TABLE tx ADD COLUMN status INTEGER")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB)")
+    conn.commit()
+    return conn
+
+def cache_get_many(conn: sqlite3.Connection, hashes: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+    found: Dict[str, Optional[Dict[str, Any]]] = {}
+    for k in range(0, len(hashes), SQL_CHUNK):
+        chunk = hashes[k:k + SQL_CHUNK]
+        q = f"SELECT hash, body, status FROM tx WHERE hash IN ({','.join('?' * len(chunk))})"
+        with _cache_lock:
+            rows = conn.execute(q, chunk).fetchall()
+        for h, body, status in rows:
+            if status == 404:
+                found[h] = None
+                continue
+            if body is None:
+                continue
+            try:
+                found[h] = json_loads(body)
+            except Exception:
+                pass
+    return found
+
+def cache_put_many(conn: sqlite3.Connection, details: Dict[str, Tuple[int, Optional[Dict[str, Any]]]]) -> None:
+    rows = []
+    for h, (status, detail) in details.items():
+        body = json_dumps(detail) if detail is not None else None
+        rows.append((h, body, status))
+    with _cache_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO tx(hash, body, status) VALUES (?, ?, ?)", rows)
+
+def cache_forget_missing(conn: sqlite3.Connection) -> int:
+    with _cache_lock, conn:
+        return conn.execute("DELETE FROM tx WHERE status = 404").rowcount
+
+def meta_get(conn: sqlite3.Connection, url: str) -> Optional[Tuple[Optional[str], Optional[str], bytes]]:
+    with _cache_lock:
+        return conn.execute("SELECT etag, last_modified, body FROM meta WHERE url = ?", (url,)).fetchone()
+
+def meta_put(conn: sqlite3.Connection, url: str, etag: Optional[str], last_modified: Optional[str], body: bytes) -> None:
+    with _cache_lock, conn:
+        conn.execute("INSERT OR REPLACE INTO meta(url, etag, last_modified, body) VALUES (?, ?, ?, ?)", (url, etag, last_modified, body))
+
 # ---------- API ----------
 
+def make_session(concurrency: int=8) -> requests.Session:
+    retry = Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUS, allowed_methods=frozenset(["GET"]))
+    pool = max(1, concurrency)
+    adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": USER_AGENT})
+    return session
+
+def get_json_conditional(session: requests.Session, cache: Optional[sqlite3.Connection], url: str, params: Optional[Dict[str, Any]]=None, timeout: float=20) -> Any:
+    key = f"{url}?{urlencode(params)}" if params else url
+    stored = meta_get(cache, key) if cache is not None else None
+    headers = {}
+    if stored is not None:
+        etag, last_modified, _ = stored
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    r = session.get(url, params=params, headers=headers, timeout=timeout)
+    if r.status_code == 304 and stored is not None:
+        return json_loads(stored[2])
+    r.raise_for_status()
+    etag = r.headers.get("ETag")
+    last_modified = r.headers.get("Last-Modified")
+    if cache is not None and (etag or last_modified):
+        meta_put(cache, key, etag, last_modified, r.content)
+    return json_loads(r.content)
+
 def extract_items_and_token(payload: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     token = None
     items: List[Dict[str, Any]] = []
@@ -132,12 +278,10 @@ def extract_items_and_token(payload: Any) -> Tuple[List[Dict[str, Any]], Optiona
         items = [{"value": it} for it in items]
     return items, token
 
-def get_current_balance(session: requests.Session, addr: str, base_url: str) -> Optional[Decimal]:
+def get_current_balance(session: requests.Session, addr: str, base_url: str, cache: Optional[sqlite3.Connection]=None) -> Optional[Decimal]:
     url = f"{base_url}/Address/{addr}"
     try:
-        r = session.get(url, timeout=20)
-        r.raise_for_status()
-        p = r.json()
+        p = get_json_conditional(session, cache, url, timeout=20)
         if isinstance(p, dict):
             cand = get_ci(p, "balance")
             if cand is None:
@@ -153,13 +297,12 @@ def get_current_balance(session: requests.Session, addr: str, base_url: str) ->
     except Exception:
         return None
 
-def fetch_all_txs(addr: str, limit: int, base_url: str, polite_sleep: float, max_pages: int=0, verbose: bool=False) -> List[Dict[str, Any]]:
-    session = requests.Session()
-    session.headers.update({"User-Agent": "idena-txs-fetcher/gh-1.0"})
+def fetch_all_txs(session: requests.Session, addr: str, limit: int, base_url: str, polite_sleep: float, max_pages: int=0, verbose: bool=False, cache: Optional[sqlite3.Connection]=None) -> Iterator[Tuple[List[Dict[str, Any]], List[str]]]:
     url = f"{base_url}/Address/{addr}/Txs"
     token = None
     page = 0
-    out: List[Dict[str, Any]] = []
+    total = 0
+    seen = set()
     while True:
         if max_pages and page >= max_pages:
             if verbose:
@@ -168,34 +311,40 @@ def fetch_all_txs(addr: str, limit: int, base_url: str, polite_sleep: float, max
         params = {"limit": limit}
         if token:
             params["continuationToken"] = token
-        for attempt in range(5):
-            try:
+        try:
+            if token:
                 resp = session.get(url, params=params, timeout=30)
-                if resp.status_code >= 500:
-                    raise RuntimeError(f"server error {resp.status_code}")
                 resp.raise_for_status()
-                data = resp.json()
-                break
-            except Exception as e:
-                wait = min(5.0, 0.5 * (attempt + 1) ** 2)
-                print(f"[pager] request failed (attempt {attempt+1}/5): {e} - sleeping {wait}s")
-                time.sleep(wait)
-        else:
-            print("[pager] giving up after 5 attempts")
+                data = json_loads(resp.content)
+            else:
+                # the newest page is the one most likely to be unchanged between runs
+                data = get_json_conditional(session, cache, url, params=params, timeout=30)
+        except Exception as e:
+            print(f"[pager] giving up on page {page+1}: {e}")
             sys.exit(1)
         items, next_token = extract_items_and_token(data)
         got = len(items) if items else 0
-        out.extend(items or [])
+        total += got
         page += 1
         token = next_token
         if verbose:
-            print(f"[pager] page {page}: got {got} - total {len(out)} - token={'present' if token else 'none'}")
+            print(f"[pager] page {page}: got {got} - total {total} - token={'present' if token else 'none'}")
+        # pages can repeat the boundary tx of the previous page, keep only the first copy of each hash
+        new_items: List[Dict[str, Any]] = []
+        new_hashes: List[str] = []
+        for it in items or []:
+            h = get_tx_hash_from_item(it)
+            if h and h not in seen:
+                seen.add(h)
+                new_items.append(it)
+                new_hashes.append(h)
+        if new_items:
+            yield new_items, new_hashes
         if not token or got == 0:
             if verbose:
                 print("[pager] no continuationToken or empty page - done")
             break
         time.sleep(polite_sleep)
-    return out
 
 def get_tx_hash_from_item(item: Dict[str, Any]) -> Optional[str]:
     v = get_ci(item, "hash", "txHash", "transactionHash", "id", "txId")
@@ -208,58 +357,119 @@ def get_tx_hash_from_item(item: Dict[str, Any]) -> Optional[str]:
             return v2.strip()
     return None
 
-def fetch_tx_detail(session: requests.Session, base_url: str, h: str) -> Optional[Dict[str, Any]]:
+async def fetch_tx_detail(session: aiohttp.ClientSession, base_url: str, h: str) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    # returns (http status, detail); status is None when the lookup failed and is worth retrying on a later run
     url = f"{base_url}/Transaction/{h}"
-    for attempt in range(4):
+    for attempt in range(RETRY_TOTAL + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
         try:
-            r = session.get(url, timeout=20)
-            if r.status_code == 404:
-                return None
-            if r.status_code >= 500:
-                raise RuntimeError(f"server error {r.status_code}")
-            r.raise_for_status()
-            p = r.json()
-            if isinstance(p, dict):
-                res = get_ci(p, "result")
-                if isinstance(res, dict):
-                    return res
-                return p
-            return None
+            async with session.get(url) as r:
+                if r.status in RETRY_STATUS:
+                    continue
+                if r.status == 404:
+                    return 404, None
+                r.raise_for_status()
+                p = json_loads(await r.read())
+                status = r.status
+                break
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            continue
         except Exception:
-            time.sleep(0.3 * (attempt + 1))
-    return None
+            return None, None
+    else:
+        return None, None
+    if isinstance(p, dict):
+        res = get_ci(p, "result")
+        if isinstance(res, dict):
+            return status, res
+        return status, p
+    return status, None
 
-def fetch_details_for_hashes(hashes: List[str], base_url: str, concurrency: int=8, cache_dir: str="tx_cache", force_refresh: bool=False, verbose: bool=False) -> Dict[str, Optional[Dict[str, Any]]]:
-    os.makedirs(cache_dir, exist_ok=True)
-    session = requests.Session()
-    session.headers.update({"User-Agent": "idena-tx-detail/gh-1.0"})
+async def _detail_worker(session: aiohttp.ClientSession, queue: "asyncio.Queue[Optional[str]]", base_url: str, fetched: Dict[str, Tuple[Optional[int], Optional[Dict[str, Any]]]], pending: Dict[str, Tuple[int, Optional[Dict[str, Any]]]], verbose: bool) -> None:
+    while True:
+        h = await queue.get()
+        if h is None:
+            return
+        status, detail = fetched[h] = await fetch_tx_detail(session, base_url, h)
+        if status is not None:
+            pending[h] = (status, detail)
+        if verbose and len(fetched) % 200 == 0:
+            print(f"[detail] fetched {len(fetched)}")
+
+def _raise_if_failed(workers: List["asyncio.Task[None]"]) -> None:
+    for w in workers:
+        if w.done() and not w.cancelled() and w.exception() is not None:
+            raise w.exception()
+
+async def _put_checked(queue: "asyncio.Queue[Optional[str]]", item: Optional[str], workers: List["asyncio.Task[None]"]) -> None:
+    # a plain queue.put on the bounded queue would wait forever once the workers have died
+    _raise_if_failed(workers)
+    if not queue.full():
+        queue.put_nowait(item)
+        return
+    put = asyncio.ensure_future(queue.put(item))
+    try:
+        while not put.done():
+            await asyncio.wait([put, *[w for w in workers if not w.done()]], return_when=asyncio.FIRST_COMPLETED)
+            _raise_if_failed(workers)
+    finally:
+        put.cancel()
+
+async def _fetch_details_async(cache: sqlite3.Connection, hash_pages: Iterable[List[str]], base_url: str, concurrency: int, force_refresh: bool, verbose: bool) -> Dict[str, Optional[Dict[str, Any]]]:
+    n = max(1, concurrency)
+    # bounded so a huge wallet holds O(concurrency) pending hashes, a full queue stalls the pager
+    queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue(maxsize=n * 4)
     results: Dict[str, Optional[Dict[str, Any]]] = {}
-    def load_or_fetch(h: str):
-        fp = os.path.join(cache_dir, f"{h}.json")
-        if not force_refresh and os.path.exists(fp):
-            try:
-                with open(fp, "r", encoding="utf-8") as f:
-                    return h, json.load(f)
-            except Exception:
-                pass
-        detail = fetch_tx_detail(session, base_url, h)
-        try:
-            with open(fp, "w", encoding="utf-8") as f:
-                json.dump(detail, f, ensure_ascii=False)
-        except Exception:
-            pass
-        return h, detail
-    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
-        futs = [ex.submit(load_or_fetch, h) for h in hashes]
-        done = 0
-        for fut in as_completed(futs):
-            h, detail = fut.result()
-            results[h] = detail
-            done += 1
-            if verbose and done % 200 == 0:
-                print(f"[detail] fetched {done}/{len(hashes)}")
+    fetched: Dict[str, Tuple[Optional[int], Optional[Dict[str, Any]]]] = {}
+    pending: Dict[str, Tuple[int, Optional[Dict[str, Any]]]] = {}
+    workers: List["asyncio.Task[None]"] = []
+    unique = 0
+    queued = 0
+    pages = iter(hash_pages)
+    connector = aiohttp.TCPConnector(limit=n)
+    timeout = aiohttp.ClientTimeout(total=20)
+    def flush(min_rows: int=1) -> None:
+        # one transaction per batch, so an interrupted run keeps what it already fetched
+        if len(pending) >= min_rows:
+            cache_put_many(cache, pending)
+            pending.clear()
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT}, trust_env=True) as session:
+            workers = [asyncio.create_task(_detail_worker(session, queue, base_url, fetched, pending, verbose)) for _ in range(n)]
+            # the pager blocks, so pull pages in a worker thread while earlier pages are being resolved
+            while True:
+                page = await asyncio.to_thread(next, pages, None)
+                if page is None:
+                    break
+                unique += len(page)
+                # --force-refresh skips the lookup only; refetched rows replace the old ones as they arrive
+                if not force_refresh:
+                    results.update(cache_get_many(cache, page))
+                for h in page:
+                    if h not in results:
+                        await _put_checked(queue, h, workers)
+                        queued += 1
+                flush(SQL_CHUNK)
+            if verbose:
+                print(f"[detail] unique hashes {unique} - cache hits {len(results)} - fetching {queued}")
+            for _ in workers:
+                await _put_checked(queue, None, workers)
+            running = set(workers)
+            while running:
+                _, running = await asyncio.wait(running, timeout=1.0)
+                _raise_if_failed(workers)
+                flush(SQL_CHUNK)
+    finally:
+        for w in workers:
+            w.cancel()
+        flush()
+    results.update((h, detail) for h, (_, detail) in fetched.items())
     return results
 
+def fetch_details_for_hashes(cache: sqlite3.Connection, hash_pages: Iterable[List[str]], base_url: str, concurrency: int=8, force_refresh: bool=False, verbose: bool=False) -> Dict[str, Optional[Dict[str, Any]]]:
+    return asyncio.run(_fetch_details_async(cache, hash_pages, base_url, concurrency, force_refresh, verbose))
+
 # ---------- transform ----------
 
 def build_records(addr: str, items: List[Dict[str, Any]], details: Dict[str, Optional[Dict[str, Any]]]) -> List[Dict[str, Any]]:
@@ -272,35 +482,28 @@ def build_records(addr: str, items: List[Dict[str, Any]], details: Dict[str, Opt
         det = details.get(h)
         if not isinstance(det, dict):
             continue
-        block = get_ci(det, "blockHeight")
-        ts = get_ci(det, "timestamp")
-        typ = get_ci(det, "type")
-        frm = get_ci(det, "from")
-        to_ = get_ci(det, "to")
-        amt = get_ci(det, "amount", "value")
-        fee = get_ci(det, "fee")
-        tips = get_ci(det, "tips")
-        block_i = i(block, 0)
-        ts_i = epoch(ts)
+        f_addr = (get_ci(det, "from") or "").lower()
+        t_addr = (get_ci(det, "to") or "").lower()
+        if f_addr != my and t_addr != my:
+            # does not move this wallet's balance - skip before parsing anything else
+            continue
+        block_i = i(get_ci(det, "blockHeight"), 0)
         if block_i <= 0:
             continue
-        amt_d = D(amt)
-        fee_d = D(fee)
-        tips_d = D(tips)
-        f_addr = (frm or "").lower()
-        t_addr = (to_ or "").lower()
+        ts_i = epoch(get_ci(det, "timestamp"))
+        typ = get_ci(det, "type")
+        amt_d = D(get_ci(det, "amount", "value"))
+        fee_d = D(get_ci(det, "fee"))
+        tips_d = D(get_ci(det, "tips"))
         if f_addr == my and t_addr != my:
             direction = "out"
-            delta = -(amt_d + fee_d + tips_d)
+            delta = -(to_atomic(amt_d) + to_atomic(fee_d) + to_atomic(tips_d))
         elif t_addr == my and f_addr != my:
             direction = "in"
-            delta = amt_d
-        elif t_addr == my and f_addr == my:
-            direction = "self"
-            delta = Decimal(0)
+            delta = to_atomic(amt_d)
         else:
-            direction = "other"
-            delta = Decimal(0)
+            direction = "self"
+            delta = 0
         recs.append({
             "hash": h,
             "block": block_i,
@@ -310,85 +513,66 @@ def build_records(addr: str, items: List[Dict[str, Any]], details: Dict[str, Opt
             "fee": str(fee_d),
             "tips": str(tips_d),
             "type": typ or "",
-            "delta": str(delta),
-            "balance": None
+            "delta": fmt_atomic(delta),
+            "balance": None,
+            "_delta_i": delta
         })
     return recs
 
-def reconstruct_balance(addr: str, recs: List[Dict[str, Any]], base_url: str, calibrate: bool=True) -> Tuple[List[Dict[str, Any]], Optional[Decimal]]:
-    session = requests.Session()
-    session.headers.update({"User-Agent": "idena-balance/gh-1.0"})
-    recs_desc = sorted(recs, key=lambda x: (x["block"], x["timestamp"]), reverse=True)
-    recs_asc = list(reversed(recs_desc))
+def reconstruct_balance(session: requests.Session, addr: str, recs: List[Dict[str, Any]], base_url: str, calibrate: bool=True, cache: Optional[sqlite3.Connection]=None, on_record: Optional[Callable[[Dict[str, Any]], None]]=None) -> Tuple[List[Dict[str, Any]], Optional[Decimal]]:
+    recs_asc = sorted(recs, key=itemgetter("block", "timestamp"))
+    deltas = [r["_delta_i"] for r in recs_asc]
     curr_balance = None
     if calibrate:
-        curr_balance = get_current_balance(session, addr, base_url)
+        curr_balance = get_current_balance(session, addr, base_url, cache=cache)
     if curr_balance is not None:
-        bal_before_oldest = curr_balance
-        for r in recs_desc:
-            if r["direction"] == "out":
-                bal_before_oldest = bal_before_oldest + (D(r["amount"]) + D(r["fee"]) + D(r["tips"]))
-            elif r["direction"] == "in":
-                bal_before_oldest = bal_before_oldest - D(r["amount"])
-        start_bal = bal_before_oldest
+        start_bal = to_atomic(curr_balance) - sum(deltas)
     else:
-        start_bal = Decimal(0)
-    bal = start_bal
+        start_bal = 0
+    balances = accumulate(deltas, initial=start_bal)
+    next(balances)
     out: List[Dict[str, Any]] = []
-    for r in recs_asc:
-        if r["direction"] == "out":
-            bal = bal - (D(r["amount"]) + D(r["fee"]) + D(r["tips"]))
-        elif r["direction"] == "in":
-            bal = bal + D(r["amount"])
-        rr = dict(r)
-        rr["balance"] = str(bal)
-        out.append(rr)
+    for r, bal in zip(recs_asc, balances):
+        rr = {k: v for k, v in r.items() if not k.startswith("_")}
+        rr["balance"] = fmt_atomic(bal)
+        if on_record is not None:
+            on_record(rr)
+        else:
+            out.append(rr)
     return out, curr_balance
 
 # ---------- io ----------
 
-def save_jsonl(path: str, rows: List[Dict[str, Any]]) -> None:
-    with open(path, "w", encoding="utf-8") as f:
-        for r in rows:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-
-def save_csv(path: str, rows: List[Dict[str, Any]]) -> None:
-    import csv
-    cols = ["hash","block","timestamp","direction","amount","fee","tips","type","delta","balance"]
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=cols)
-        w.writeheader()
-        for r in rows:
-            w.writerow({k: r.get(k, "") for k in cols})
+def timeline_csv_writer(f) -> csv.DictWriter:
+    w = csv.DictWriter(f, fieldnames=TIMELINE_COLS, restval="", extrasaction="ignore")
+    w.writeheader()
+    return w
 
 def save_tail_csv(rows: List[Dict[str, Any]], out_prefix: str, n: int) -> str:
-    import csv
     tail = rows[-n:] if n > 0 else rows
     path = f"{out_prefix}.tail_{n}.csv"
-    with open(path, "w", newline="", encoding="utf-8") as f:
+    with open(path, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as f:
         w = csv.writer(f)
         w.writerow(["block","timestamp","iso_utc","direction","amount","fee","tips","balance","hash"])
-        for r in tail:
-            w.writerow([r["block"], r["timestamp"], iso_utc(r["timestamp"]), r["direction"], r["amount"], r["fee"], r["tips"], r["balance"], r["hash"]])
+        w.writerows([r["block"], r["timestamp"], iso_utc(r["timestamp"]), r["direction"], r["amount"], r["fee"], r["tips"], r["balance"], r["hash"]] for r in tail)
     return path
 
-def plot_series(path_png: str, rows: List[Dict[str, Any]], title: str) -> None:
-    if plt is None or not rows:
+def plot_series(path_png: str, blocks: Sequence[int], balances: Sequence[float], title: str) -> None:
+    if Figure is None or not len(blocks):
         return
-    xs = [r["block"] for r in rows]
-    ys = [float(D(r["balance"])) for r in rows]
-    plt.figure()
-    plt.plot(xs, ys, linewidth=1.5)
-    ax = plt.gca()
+    xs = np.asarray(blocks, dtype=np.int64)
+    ys = np.asarray(balances, dtype=np.float64)
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.plot(xs, ys, linewidth=1.5)
     ax.grid(True, which="both", linestyle="--", linewidth=0.5, alpha=0.6)
     ax.xaxis.set_major_formatter(mticker.StrMethodFormatter("{x:,.0f}"))
     ax.yaxis.set_major_formatter(mticker.StrMethodFormatter("{x:,.3f}"))
-    plt.xlabel("block")
-    plt.ylabel("wallet balance [iDNA]")
-    plt.title(title)
-    plt.tight_layout()
-    plt.savefig(path_png, dpi=180)
-    plt.close()
+    ax.set_xlabel("block")
+    ax.set_ylabel("wallet balance [iDNA]")
+    ax.set_title(title)
+    fig.tight_layout()
+    fig.savefig(path_png, dpi=180)
 
 # ---------- cli ----------
 
@@ -403,34 +587,35 @@ def main():
     ap.add_argument("--concurrency", type=int, default=8)
     ap.add_argument("--cache-dir", default="tx_cache")
     ap.add_argument("--force-refresh", action="store_true")
+    ap.add_argument("--retry-404", action="store_true", help="forget cached 404s and look those hashes up again")
     ap.add_argument("--no-calibrate", action="store_true", help="do not query current balance - relative curve from 0")
     ap.add_argument("--tail", type=int, default=25)
     ap.add_argument("--base-url", default=BASE_URL)
     ap.add_argument("--verbose", action="store_true")
     args = ap.parse_args()
 
-    os.makedirs(args.cache_dir, exist_ok=True)
+    session = make_session(args.concurrency)
+    cache = open_cache(args.cache_dir)
+    if args.retry_404:
+        dropped = cache_forget_missing(cache)
+        if args.verbose:
+            print(f"[detail] forgot {dropped} cached 404s")
 
-    print(f"Fetching tx list for {args.address} ...")
-    items = fetch_all_txs(addr=args.address, limit=args.limit, base_url=args.base_url, polite_sleep=args.sleep, max_pages=args.max_pages, verbose=args.verbose)
-    print(f"Fetched {len(items)} items - resolving details ...")
-    hashes: List[str] = []
-    for it in items:
-        h = get_tx_hash_from_item(it)
-        if h:
-            hashes.append(h)
-    hashes = list(dict.fromkeys(hashes))
-    if args.verbose:
-        print(f"Unique hashes: {len(hashes)}")
-    details = fetch_details_for_hashes(hashes, base_url=args.base_url, concurrency=args.concurrency, cache_dir=args.cache_dir, force_refresh=args.force_refresh, verbose=args.verbose)
+    print(f"Fetching tx list and details for {args.address} ...")
+    items: List[Dict[str, Any]] = []
+    def hash_pages() -> Iterator[List[str]]:
+        for page_items, page_hashes in fetch_all_txs(session, addr=args.address, limit=args.limit, base_url=args.base_url, polite_sleep=args.sleep, max_pages=args.max_pages, verbose=args.verbose, cache=cache):
+            items.extend(page_items)
+            yield page_hashes
+    details = fetch_details_for_hashes(cache, hash_pages(), base_url=args.base_url, concurrency=args.concurrency, force_refresh=args.force_refresh, verbose=args.verbose)
+    print(f"Fetched {len(items)} items - resolved {len(details)} details")
     recs = build_records(args.address, items, details)
     print(f"Records with blockHeight: {len(recs)}")
     if not recs:
         print("No usable records - exit")
         sys.exit(0)
 
-    series, curr_balance = reconstruct_balance(args.address, recs, args.base_url, calibrate=not args.no_calibrate)
-    if any(r["block"] == 0 for r in series):
+    if any(r["block"] == 0 for r in recs):
         print("[fatal] a row with block=0 slipped through - abort")
         sys.exit(2)
 
@@ -439,17 +624,33 @@ def main():
     png_all = f"{args.out_prefix}.balance_all.png"
     png_last = f"{args.out_prefix}.balance_last_1000000.png"
 
-    save_jsonl(jsonl_path, series)
-    save_csv(csv_path, series)
-    tail_path = save_tail_csv(series, args.out_prefix, n=args.tail)
+    # rows go to disk as they are reconstructed, only the tail and the plot columns stay in memory
+    tail: Deque[Dict[str, Any]] = deque(maxlen=args.tail if args.tail > 0 else None)
+    blocks = array("q")
+    balances = array("d")
+    with open(jsonl_path, "wb", buffering=WRITE_BUFFER) as jf, open(csv_path, "w", newline="", encoding="utf-8", buffering=WRITE_BUFFER) as cf:
+        cw = timeline_csv_writer(cf)
+        def on_record(r: Dict[str, Any]) -> None:
+            jf.write(json_dumps(r, newline=True))
+            cw.writerow(r)
+            tail.append(r)
+            blocks.append(r["block"])
+            balances.append(float(r["balance"]))
+        _, curr_balance = reconstruct_balance(session, args.address, recs, args.base_url, calibrate=not args.no_calibrate, cache=cache, on_record=on_record)
+    cache.close()
+
+    cutoff = blocks[-1] - 1_000_000
+    k = bisect_left(blocks, cutoff)
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        tail_fut = ex.submit(save_tail_csv, list(tail), args.out_prefix, args.tail)
+        plot_futs = [ex.submit(plot_series, png_all, blocks, balances, args.title)]
+        if k < len(blocks):
+            plot_futs.append(ex.submit(plot_series, png_last, blocks[k:], balances[k:], f"{args.title} - last 1,000,000 blocks"))
+        tail_path = tail_fut.result()
+        for fut in plot_futs:
+            fut.result()
     print(f"Wrote {jsonl_path}, {csv_path}, {tail_path}")
-
-    plot_series(png_all, series, args.title)
-    max_block = max(r["block"] for r in series)
-    cutoff = max_block - 1_000_000
-    last = [r for r in series if r["block"] >= cutoff]
-    if last:
-        plot_series(png_last, last, f"{args.title} - last 1,000,000 blocks")
+    if len(plot_futs) > 1:
         print(f"Saved plots: {png_all}, {png_last}")
     else:
         print(f"Saved plot: {png_all}")
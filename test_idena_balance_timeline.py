@@ -0,0 +1,57 @@
+import asyncio, sqlite3, tempfile, time, unittest
+from unittest import mock
+
+import idena_balance_timeline as ibt
+
+
+async def fake_fetch_tx_detail(session, base_url, h):
+    await asyncio.sleep(0)
+    return 200, {"hash": h}
+
+def hash_pages(n, size=40):
+    hashes = [f"0x{k:064x}" for k in range(n)]
+    return [hashes[k:k + size] for k in range(0, n, size)]
+
+HANG_TIMEOUT = 10
+
+def run_fetch(cache, pages, concurrency=2):
+    # the timeout turns a hang into a test failure instead of a stuck suite
+    return asyncio.run(asyncio.wait_for(ibt._fetch_details_async(cache, pages, "http://unused", concurrency, False, False), HANG_TIMEOUT))
+
+
+class FetchDetailsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ibt.open_cache(self.tmp.name)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def test_batches_are_written_to_cache(self):
+        with mock.patch.object(ibt, "fetch_tx_detail", fake_fetch_tx_detail), mock.patch.object(ibt, "SQL_CHUNK", 5):
+            results = run_fetch(self.cache, hash_pages(240))
+        self.assertEqual(len(results), 240)
+        self.assertEqual(self.cache.execute("SELECT COUNT(*) FROM tx").fetchone()[0], 240)
+
+    def test_cache_write_error_is_raised_instead_of_hanging(self):
+        def broken_put(conn, details):
+            raise sqlite3.OperationalError("database is locked")
+        with mock.patch.object(ibt, "fetch_tx_detail", fake_fetch_tx_detail), mock.patch.object(ibt, "SQL_CHUNK", 5), \
+                mock.patch.object(ibt, "cache_put_many", broken_put):
+            start = time.monotonic()
+            with self.assertRaises(sqlite3.OperationalError):
+                run_fetch(self.cache, hash_pages(240))
+        # the error must surface right away, not from the final flush after the hang timeout
+        self.assertLess(time.monotonic() - start, HANG_TIMEOUT / 2)
+
+    def test_dead_worker_is_raised_instead_of_hanging(self):
+        async def broken_fetch(session, base_url, h):
+            raise RuntimeError("worker died")
+        with mock.patch.object(ibt, "fetch_tx_detail", broken_fetch):
+            with self.assertRaises(RuntimeError):
+                run_fetch(self.cache, hash_pages(240))
+
+
+if __name__ == "__main__":
+    unittest.main()